@@ -14,23 +14,24 @@
 # lengths can be download using the "CSV" option under download
 
 def usage():
-    print("Usage: {} allprefs.csv [pcassignment.csv] [-b] [-s] [-o] [-l data.csv]".format(sys.argv[0]))    
+    print("Usage: {} allprefs.csv [pcassignment.csv] [-b] [-s] [-o|-f] [-l data.csv]".format(sys.argv[0]))    
     print("\nOptions:")
     print("  -b or --black: black and white output")
     print("  -s or --scale: autoscale preferences according to individual min/max (otherwise assume -20/20)")
     print("  -o or --order: reorder papers and reviewers to move high score to the diagonal")
+    print("  -f or --fast: like --order, but with a faster approximate ordering of papers (spectral seriation)")
     print("  -l or --lengths: read paper lengths from CSV file")
     
 import csv
-import itertools
+import io
 import re
-import math
-import functools
 
 import getopt, sys
 
+import numpy as np
+
 try:
-    opts, args = getopt.gnu_getopt(sys.argv[1:], "bsol:", ["black", "scale", "order", "lengths="])
+    opts, args = getopt.gnu_getopt(sys.argv[1:], "bsofl:", ["black", "scale", "order", "fast", "lengths="])
 except getopt.GetoptError as err:
     # print help information and exit:
     print(err)  # will print something like "option -a not recognized"
@@ -52,6 +53,8 @@ for o, a in opts:
         opt_black = 1
     elif o in ("-o", "--order"):
         opt_order = 1
+    elif o in ("-f", "--fast"):
+        opt_order = 2
     elif o in ("-l", "--lengths"):
         lengths_file = a
     else:
@@ -68,30 +71,34 @@ else:
     sys.exit(2)
 
 # Helper function
+latex_conv = {
+    '&': r'\&',
+    '%': r'\%',
+    '$': r'\$',
+    '#': r'\#',
+    '_': r'\_',
+    '{': r'\{',
+    '}': r'\}',
+    '~': r'\textasciitilde{}',
+    '^': r'\^{}',
+    '\\': r'\textbackslash{}',
+    '<': r'\textless{}',
+    '>': r'\textgreater{}',
+}
+latex_regex = re.compile('|'.join(re.escape(str(key)) for key in sorted(latex_conv.keys(), key = lambda item: - len(item))))
+
 def latex_encode(text):
     """
         :param text: a plain text message
         :return: the message escaped to appear correctly in LaTeX
     """
-    conv = {
-        '&': r'\&',
-        '%': r'\%',
-        '$': r'\$',
-        '#': r'\#',
-        '_': r'\_',
-        '{': r'\{',
-        '}': r'\}',
-        '~': r'\textasciitilde{}',
-        '^': r'\^{}',
-        '\\': r'\textbackslash{}',
-        '<': r'\textless{}',
-        '>': r'\textgreater{}',
-    }
-    regex = re.compile('|'.join(re.escape(str(key)) for key in sorted(conv.keys(), key = lambda item: - len(item))))
-    return regex.sub(lambda match: conv[match.group()], text)
+    return latex_regex.sub(lambda match: latex_conv[match.group()], text)
 
 
 
+# The document is built in memory, and written at the end
+out = io.StringIO()
+
 # Print LaTeX header
 print (r"""\documentclass{standalone}
 
@@ -104,11 +111,11 @@ print (r"""\documentclass{standalone}
 \usepackage[utf8]{inputenc}
 
 \newif\ifcolor
-""")
+""", file=out)
 if opt_black:
-    print ("\colorfalse")
+    print ("\colorfalse", file=out)
 else:
-    print ("\colortrue")
+    print ("\colortrue", file=out)
 print(r"""\ifcolor
 \definecolor{MyGreen-hsb}{hsb}{0.34065,1,0.91}
 \newcommand{\rate}[2]{\ifnum#1=-100%
@@ -161,43 +168,62 @@ print(r"""\ifcolor
 \sffamily
 \begin{tabular}{|l*{99}{|s}|}
 \hline
-""")
+""", file=out)
 
 
-papers = {}
-pc = {}
-prefs= {}
-prefs_type= {}
-assigned = {}
-email = {}
+# Papers and reviewers are numbered in order of appearance
+paper_idx = {}
+paper_ids = []
+titles = []
+n_pages = []
+pc_idx = {}
+pc_names = []
+pc_email = {}
+# Preferences as (paper index, reviewer index, score, type) tuples
+# Types are the index in pref_codes: topic score, preference, or conflict
+pref_codes = "TPC"
+pref_papers = []
+pref_pc = []
+pref_scores = []
+pref_types = []
+# Assignment as (paper index, reviewer index) pairs
+assigned_papers = []
+assigned_pc = []
 
 # Process preferences
 with open(pref_file) as csvDataFile:
-    csvReader = csv.DictReader(csvDataFile)
+    csvReader = csv.reader(csvDataFile)
+    header = next(csvReader)
+    PAPER, TITLE, FIRST, LAST, EMAIL, PREFERENCE, TOPIC_SCORE, CONFLICT = (
+        header.index(key) for key in ('paper', 'title', 'first', 'last', 'email', 'preference', 'topic_score', 'conflict') )
     for line in csvReader:
-        if line['paper'] not in papers:
-            papers[line['paper']] = {}
-            papers[line['paper']]['title'] = line['title']
-            papers[line['paper']]['n_pages'] = 20
-            prefs[line['paper']] = {}
-            prefs_type[line['paper']] = {}
-            assigned[line['paper']] = {}
-        name = line['first']+" "+line['last']
-        if name not in pc:
-            pc[name] = {}
-            pc[name]['num'] = len(pc)
-            pc[name]['email'] = line['email']
-            email[line['email']] = name
+        if not line:
+            continue
+        # ids and names repeat on many rows: intern them
+        paper = sys.intern(line[PAPER])
+        if paper not in paper_idx:
+            paper_idx[paper] = len(paper_ids)
+            paper_ids.append(paper)
+            titles.append(line[TITLE])
+            n_pages.append(20)
+        name = sys.intern(line[FIRST]+" "+line[LAST])
+        if name not in pc_idx:
+            pc_idx[name] = len(pc_names)
+            pc_names.append(name)
+            pc_email[line[EMAIL]] = pc_idx[name]
             
-        score = line['topic_score']
-        prefs_type[line['paper']][name] = 'T'
-        if line['preference']:
-            score = line['preference']
-            prefs_type[line['paper']][name] = 'P'
-        if line['conflict'] == 'conflict':
+        score = line[TOPIC_SCORE]
+        kind = 'T'
+        if line[PREFERENCE]:
+            score = line[PREFERENCE]
+            kind = 'P'
+        if line[CONFLICT] == 'conflict':
             score = "-100"
-            prefs_type[line['paper']][name] = 'C'
-        prefs[line['paper']][name] = int(score)
+            kind = 'C'
+        pref_papers.append(paper_idx[paper])
+        pref_pc.append(pc_idx[name])
+        pref_scores.append(int(score))
+        pref_types.append(pref_codes.index(kind))
 
 
 # Process lengths
@@ -205,7 +231,7 @@ if lengths_file:
     with open(lengths_file) as csvDataFile:
         csvReader = csv.DictReader(csvDataFile)
         for line in csvReader:
-            papers[line['ID']]['n_pages'] = int(line['Pages'])
+            n_pages[paper_idx[line['ID']]] = int(line['Pages'])
 
 # Process assignment
 if assign_file:
@@ -213,126 +239,206 @@ if assign_file:
         csvReader = csv.DictReader(csvDataFile)
         for line in csvReader:
             if line['action'] == "primary":
-                assigned[line['paper']][email[line['email']]] = 1
+                assigned_papers.append(paper_idx[line['paper']])
+                assigned_pc.append(pc_email[line['email']])
+
+# Dense matrices, indexed by paper and reviewer index
+# present is False when there is no preference; scaled is only valid for scores > -100
+shape = (len(paper_ids), len(pc_names))
+present = np.zeros(shape, dtype=bool)
+present[pref_papers, pref_pc] = True
+scores = np.zeros(shape, dtype=np.int32)
+scores[pref_papers, pref_pc] = pref_scores
+valid = present & (scores > -100)
+ptype = np.zeros(shape, dtype=np.uint8)
+ptype[pref_papers, pref_pc] = pref_types
+assigned_mat = np.zeros(shape, dtype=bool)
+assigned_mat[assigned_papers, assigned_pc] = True
+n_pages = np.array(n_pages, dtype=np.int32)
 
-# Compute individual min/max
+# Compute individual min/max (including 0)
 if opt_scale:
-    for name in pc:
-        min = 0
-        max = 0
-        for p in papers:
-            if name in prefs[p]:
-                score = prefs[p][name]
-                if score > -100:
-                    if score > max:
-                        max = score
-                    if score < min:
-                        min = score
-        pc[name]['min'] = min
-        pc[name]['max'] = max
+    mins = np.where(valid, scores, 0).min(axis=0, initial=0).astype(np.int64)
+    maxs = np.where(valid, scores, 0).max(axis=0, initial=0).astype(np.int64)
 else:
-    for name in pc:
-        pc[name]['min'] = -20
-        pc[name]['max'] =  20
-        
-prefs_scaled = {}
-for p in papers:
-    prefs_scaled[p] = {}
-    for name in pc:
-        if name in prefs[p] and prefs[p][name] > -100:
-            prefs_scaled[p][name] = int(100*(prefs[p][name]-pc[name]['min'])/(pc[name]['max']-pc[name]['min']))
-            if prefs_scaled[p][name] > 100:
-                prefs_scaled[p][name] = 100
-            if prefs_scaled[p][name] < 0:
-                prefs_scaled[p][name] = 0
+    mins = np.full(len(pc_names), -20)
+    maxs = np.full(len(pc_names),  20)
 
-if opt_order:
+scaled = (scores.astype(np.int64)-mins)*100 // np.maximum(maxs-mins, 1)
+scaled = np.where(valid, np.clip(scaled, 0, 100), 0).astype(np.int8) # between 0 and 100
+
+if opt_order == 1:
     # Sort papers by similarity
-    sorted_papers = [ [ p ] for p in papers ]
-    @functools.cache
-    def paper_dist(p1, p2):
-        s = 0 # sum of squares
-        t = 0 # number of items
-        for name in pc:
-            if name in prefs_scaled[p1] and name in prefs_scaled[p2]:
-                s += (prefs_scaled[p1][name]-prefs_scaled[p2][name])**2
-                t += 1
-        return math.sqrt(s)/math.sqrt(t)
-        
-    def papers_dist(l1, l2):
-        p = 1
-        t = 0
-        for p1 in l1:
-            for p2 in l2:
-                p *= paper_dist(p1, p2)
-                t += 1
-        return p**(1/t)
-    
-    while len(sorted_papers) > 1:
-        best = 0, 1
-        for i in range(len(sorted_papers)):
-            for j in range(i+1,len(sorted_papers)):
-                if papers_dist(sorted_papers[i], sorted_papers[j]) < papers_dist(sorted_papers[best[0]], sorted_papers[best[1]]):
-                    best = i, j
-        sorted_papers = ( sorted_papers[:best[0]] +
-                          [ sorted_papers[best[0]] + sorted_papers[best[1]]] +
-                          sorted_papers[best[0]+1:best[1]] +
-                          sorted_papers[best[1]+1:] )
-    
-    sorted_papers = sorted_papers[0]
-    
+    # We use hierarchical clustering, where the distance between two clusters
+    # is the geometric mean of the distances between their papers, i.e.
+    # average linkage on log-distances (with the Lance-Williams update).
+    # We always merge the closest pair of clusters, the first one in (i, j)
+    # order in case of ties; each cluster caches its nearest neighbor among
+    # the following clusters, so that a merge only rescans a few rows.
+
+    # Papers with identical scores are at distance 0 from each other, and
+    # have the same distance to any other paper: compute distances once per
+    # group of identical papers
+    # (papers without any valid score are not at distance 0 from each other)
+    groups = {}
+    for i, key in enumerate(np.where(valid, scaled, -1)):
+        groups.setdefault(key.tobytes() if valid[i].any() else i, []).append(i)
+    groups = list(groups.values())
+    first = [ g[0] for g in groups ]
+
+    # Distance between papers: RMS difference over common reviewers
+    # (papers without common reviewers are at the maximal distance)
+    # Sums over common reviewers are computed as matrix products, using
+    # (x-y)^2 = x^2 + y^2 - 2xy; all values are small integers, so this is exact
+    m = valid[first].astype(np.float64)
+    x = scaled[first].astype(np.float64) # 0 when not valid
+    s = (x*x) @ m.T + m @ (x*x).T - 2 * (x @ x.T) # sum of squares
+    t = m @ m.T # number of items
+    paper_dist = np.where(t > 0, np.sqrt(s)/np.sqrt(np.maximum(t, 1)), 100)
+    with np.errstate(divide='ignore'):
+        log_dist = np.log(paper_dist)
+
+    # A group is clustered as a single item, unless one of its papers is also
+    # at distance 0 from another paper: tied merges would then interleave
+    zero = np.isneginf(log_dist)
+    np.fill_diagonal(zero, False)
+    clusters = []
+    group_of = []
+    for g in range(len(groups)):
+        for c in ([ groups[g] ] if not zero[g].any() else [ [ p ] for p in groups[g] ]):
+            clusters.append(c)
+            group_of.append(g)
+    order = sorted(range(len(clusters)), key=lambda c: clusters[c][0])
+    clusters = [ clusters[c] for c in order ]
+    group_of = [ group_of[c] for c in order ]
+
+    # Clusters are indexed in order of their first paper; merged clusters keep
+    # the smallest index, and list the papers of the earlier cluster first
+    size = [ len(c) for c in clusters ]
+    alive = np.ones(len(clusters), dtype=bool)
+    # Distance between clusters; inf on the diagonal and for merged clusters
+    # (papers of a group that is not clustered as a single item get the
+    # distance of the group to itself, i.e. 0)
+    dist = log_dist[np.ix_(group_of, group_of)]
+    np.fill_diagonal(dist, np.inf)
+
+    # Distances closer than eps are ties, so that rounding errors in the
+    # Lance-Williams update do not decide which pair is merged first
+    eps = 1e-9
+    def first_min(v):
+        return int(np.argmax(v <= v.min() + eps))
+
+    # Nearest neighbor of i among the following clusters (first one in case of ties)
+    nn = np.zeros(len(clusters), dtype=np.intp)
+    nnd = np.full(len(clusters), np.inf)
+    def update_nn(i):
+        if i+1 < len(clusters):
+            nn[i] = i+1 + first_min(dist[i, i+1:])
+            nnd[i] = dist[i, nn[i]]
+    for i in range(len(clusters)):
+        update_nn(i)
+
+    for _ in range(len(clusters)-1):
+        i = first_min(nnd)
+        j = int(nn[i])
+        with np.errstate(invalid='ignore'): # NaN in columns i and j, reset below
+            dist[i] = (size[i]*dist[i] + size[j]*dist[j])/(size[i]+size[j])
+        dist[i, i] = np.inf
+        dist[:, i] = dist[i]
+        dist[j] = dist[:, j] = np.inf
+        clusters[i] = clusters[i] + clusters[j]
+        size[i] += size[j]
+        alive[j] = False
+        nnd[j] = np.inf
+
+        # Clusters before i: only the distance to i changed
+        d = dist[:i, i]
+        better = alive[:i] & ((d < nnd[:i] - eps) | ((d <= nnd[:i] + eps) & (i < nn[:i])))
+        nn[:i][better] = i
+        nnd[:i][better] = d[better]
+        # Rescan i, and the clusters whose nearest neighbor was i or j
+        stale = alive[:j] & ((nn[:j] == i) | (nn[:j] == j))
+        stale[i] = True
+        for k in np.flatnonzero(stale):
+            update_nn(k)
+
+    sorted_papers = clusters[0]
+elif opt_order == 2:
+    # Sort papers by the Fiedler vector of the similarity graph
+    # (eigenvector of the second smallest eigenvalue of the normalized Laplacian)
+    # The similarity x @ x.T has rank at most R, and the normalized similarity
+    # is y @ y.T: its eigenvectors are the left singular vectors of y, so we
+    # never build the P x P matrix
+    x = scaled.astype(np.float64) # 0 when not valid
+    d = 1/np.sqrt(np.maximum(x @ x.sum(axis=0), 1))
+    y = d[:, None] * x
+    if min(y.shape) > 1:
+        U = np.linalg.svd(y, full_matrices=False)[0]
+        sorted_papers = np.argsort(d * U[:, 1], kind='stable').tolist()
+    else:
+        # No second vector with a single paper or reviewer: keep the input order
+        sorted_papers = range(len(paper_ids))
+else:
+    sorted_papers = range(len(paper_ids))
+
+if opt_order:
     # Sort authors by affinity with sorted papers
-    def affinity(name):
-        s = 0
-        t = 0
-        for i in range(len(sorted_papers)):
-            if name in prefs_scaled[sorted_papers[i]]:
-                s += prefs_scaled[sorted_papers[i]][name]*i
-                t += prefs_scaled[sorted_papers[i]][name]
-        if t > 0:
-            return s / t
-        else:
-            return -1
-    sorted_pc = sorted(pc, key=affinity)
+    # (average position of their papers, weighted by scaled preference)
+    S = scaled[sorted_papers].astype(np.int64) # 0 when not valid
+    s = np.arange(len(sorted_papers)) @ S
+    t = S.sum(axis=0)
+    affinity = np.where(t > 0, s / np.maximum(t, 1), -1)
+    sorted_pc = np.argsort(affinity, kind='stable').tolist()
 else:
-    sorted_papers = papers
-    sorted_pc = pc
+    sorted_pc = range(len(pc_names))
     
+# Names and titles as they appear in LaTeX
+enc_names = [ latex_encode(name) for name in pc_names ]
+enc_titles = [ latex_encode(title) for title in titles ]
+
 # Print PC list
-for name in sorted_pc:
+pages_per_pc = n_pages @ assigned_mat.astype(np.int32) # number of pages assigned to each reviewer
+head = [ "" ]
+for r in sorted_pc:
     pages = ""
     if lengths_file:
-        t = 0
-        for p in papers:
-            if name in assigned[p]:
-                t += papers[p]['n_pages']
-        pages = "\\pp{"+str(t)+"} "
-    print (" & \\rot{"+pages+latex_encode(name)+"}", end='');
-print ("\\\\ \\hline")
+        pages = "\\pp{"+str(pages_per_pc[r])+"} "
+    head.append("\\rot{"+pages+enc_names[r]+"}")
+print (" & ".join(head)+"\\\\ \\hline", file=out)
+
+# Format paper scores
+# Cells without a score only depend on whether the paper is assigned
+unknown_cell = ( "\\Prate{50}{?}", "\\PrateA{50}{?}" )
+conflict_cell = ( "\\Prate{-100}{C}", "\\PrateA{-100}{C}" )
+negative_cell = ( "\\Prate{-100}{-100}", "\\PrateA{-100}{-100}" )
+cells = []
+for row in zip(present.tolist(), scores.tolist(), scaled.tolist(), ptype.tolist(), assigned_mat.tolist()):
+    cells.append([])
+    for known, score, s, t, a in zip(*row):
+        if not known:
+            cells[-1].append(unknown_cell[a])
+        elif pref_codes[t] == 'C':
+            cells[-1].append(conflict_cell[a])
+        elif score == -100:
+            cells[-1].append(negative_cell[a])
+        else:
+            k = pref_codes[t]
+            cells[-1].append(f"\\{k}rate{'A' if a else ''}{{{s}}}{{{k}{score}}}")
 
-# Helper function
-def pretty(p, name):
-    a = "A" if name in assigned[p] else ""
-    if name not in prefs[p]:
-        return "\\Prate"+a+"{50}{?}"
-    if prefs_type[p][name] == 'C':
-        return "\\Prate"+a+"{-100}{C}"
-    if prefs[p][name] == -100:
-        return "\\Prate"+a+"{-100}{-100}"
-    return "\\"+prefs_type[p][name]+"rate"+a+"{"+str(prefs_scaled[p][name])+"}{"+prefs_type[p][name]+str(prefs[p][name])+"}"
-    
-    
 # Print paper scores
-for p in sorted_papers:
+for i in sorted_papers:
+    p = paper_ids[i]
     pages = ""
     if lengths_file:
-        pages = "\\pp{"+str(papers[p]['n_pages'])+"} "
-    print ("\\eqmakebox[nn][l]{"+p+".} \\trunc{"+pages+latex_encode(papers[p]['title'])+"}", end='')
-    for name in sorted_pc:
-        print (" & "+pretty(p,name),end='')
-    print (" & "+p+" \\\\ \\hline")
+        pages = "\\pp{"+str(n_pages[i])+"} "
+    row = [ "\\eqmakebox[nn][l]{"+p+".} \\trunc{"+pages+enc_titles[i]+"}" ]
+    row += [ cells[i][r] for r in sorted_pc ]
+    row.append(p+" \\\\ \\hline")
+    print (" & ".join(row), file=out)
     
 # Print LaTeX footer
 print (r"""\end{tabular}
 
-\end{document}""")
+\end{document}""", file=out)
+
+sys.stdout.write(out.getvalue())